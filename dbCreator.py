@@ -1,27 +1,42 @@
 #!/usr/bin/python
 from asyncio.events import AbstractEventLoop
 import aiosqlite
-import os
 import asyncio
 import os
-import glob
+import shutil
 
 filename: str = "db.db"
-os.remove(filename)
 
-create_query: str = "CREATE TABLE IMAGES( id  INTEGER PRIMARY KEY, filename TEXT NOT NULL, filename_oryginal TEXT NOT NULL, hash TEXT NOT NULL,created INTEGER NOT NULL );"
+create_query: str = "CREATE TABLE IMAGES( id  INTEGER PRIMARY KEY, filename TEXT NOT NULL, filename_oryginal TEXT NOT NULL, hash TEXT NOT NULL,created INTEGER NOT NULL, sizes TEXT NOT NULL DEFAULT '[]' );"
+index_query: str = "CREATE UNIQUE INDEX idx_hash ON IMAGES(hash);"
 
 
-async def create() -> None:
-    async with aiosqlite.connect("db.db") as db:
+def remove_db() -> None:
+    for path in (filename, f"{filename}-wal", f"{filename}-shm"):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def reset_files() -> None:
+    shutil.rmtree("files", ignore_errors=True)
+    os.makedirs("files")
+
+
+async def create_db() -> None:
+    async with aiosqlite.connect(filename) as db:
         await db.execute(create_query)
+        await db.execute(index_query)
         await db.commit()
 
-    files = glob.glob("files/*")
-    for f in files:
-        os.remove(f)
+
+async def create() -> None:
+    loop: AbstractEventLoop = asyncio.get_event_loop()
+    await loop.run_in_executor(None, remove_db)
+    await asyncio.gather(create_db(), loop.run_in_executor(None, reset_files))
 
 
 if __name__ == "__main__":
     loop: AbstractEventLoop = asyncio.get_event_loop()
-    loop.run_until_complete(create())
\ No newline at end of file
+    loop.run_until_complete(create())
@@ -1,20 +1,24 @@
 import asyncio
-import hashlib
-import imghdr
 import io
+import json
+import logging
 import os
+import random
 import uuid
-from concurrent.futures import ThreadPoolExecutor
-from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
 from enum import Enum
 from functools import partial
-from math import floor
-from typing import Callable, Dict, Iterable, Optional, Tuple, Union
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
 
 import aiofiles as aiof
 import aiosqlite
 from aiocache import Cache
+from aiocache.serializers import PickleSerializer
+from blake3 import blake3
 from fastapi import (
+    BackgroundTasks,
     FastAPI,
     File,
     HTTPException,
@@ -22,24 +26,117 @@ from fastapi import (
     UploadFile,
     status,
     Request,
+    Query,
 )
 from fastapi.responses import HTMLResponse
 from PIL import Image
 
+try:
+    import pyvips
+# a missing libvips shared library surfaces as OSError from cffi's dlopen
+except (ImportError, OSError):  # pragma: nocover
+    pyvips = None  # type: ignore
+
 from .icon import favicon_bytes
 from .metadata import tags_metadata
-from .tools import BytesIOResponse
 from .tools import cache as z_cache
-from .tools import current_time_millis
+from .tools import (
+    DATE_FORMAT,
+    current_time_millis,
+    format_last_modified,
+    formatted_now,
+    make_etag,
+)
 
 import time
 
 CACHE_TIME_IN_SEC = 60 * 60
+REDIS_HOST = os.getenv("REDIS_HOST", "127.0.0.1")
+REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+# every gunicorn worker owns a render pool, split the cores between them
+RENDER_PROCESSES = int(os.getenv("RENDER_PROCESSES", "0")) or max(
+    1, (os.cpu_count() or 1) // int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
+)
+SIZE_LADDER = (1024, 512, 256, 128)
+UPLOAD_CHUNK_SIZE = 1 << 20
+SIGNATURES: Tuple[Tuple[bytes, str], ...] = (
+    (b"\xff\xd8\xff", "jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+    (b"BM", "bmp"),
+)
 
+logger = logging.getLogger(__name__)
 loop = asyncio.get_event_loop()
-cache = Cache(ttl=CACHE_TIME_IN_SEC)
+cache = Cache(
+    Cache.REDIS,
+    endpoint=REDIS_HOST,
+    port=REDIS_PORT,
+    ttl=CACHE_TIME_IN_SEC,
+    serializer=PickleSerializer(),
+)
 thread_pool = ThreadPoolExecutor()
+process_pool = ProcessPoolExecutor(max_workers=RENDER_PROCESSES)
 app = FastAPI(openapi_tags=tags_metadata)
+db: Optional[aiosqlite.Connection] = None
+
+
+@app.on_event("startup")
+async def open_db() -> None:
+    global db
+    db = await aiosqlite.connect("db.db", check_same_thread=False)
+    # WAL lets readers in get proceed while upload writes
+    await db.executescript(
+        "PRAGMA journal_mode=WAL;"
+        "PRAGMA synchronous=NORMAL;"
+        "PRAGMA mmap_size=268435456;"
+        "PRAGMA temp_store=MEMORY;"
+    )
+    # all workers start together, hold the write lock while checking the schema
+    await db.execute("BEGIN IMMEDIATE;")
+    cursor: aiosqlite.Cursor = await db.execute("PRAGMA table_info(IMAGES);")
+    if "sizes" not in [column[1] for column in await cursor.fetchall()]:
+        await db.execute(
+            "ALTER TABLE IMAGES ADD COLUMN sizes TEXT NOT NULL DEFAULT '[]';"
+        )
+    await db.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_hash ON IMAGES(hash);")
+    await db.commit()
+
+
+@app.on_event("shutdown")
+async def close_db() -> None:
+    if db is not None:
+        await db.close()
+
+
+async def run_in_process_pool(func: Callable[..., Any], *args: Any) -> Any:
+    global process_pool
+    pool: ProcessPoolExecutor = process_pool
+    try:
+        return await loop.run_in_executor(pool, partial(func, *args))
+    except BrokenProcessPool:
+        # a crashed child (e.g. OOM on a decompression bomb) breaks the whole pool
+        if pool is process_pool:
+            process_pool = ProcessPoolExecutor(max_workers=RENDER_PROCESSES)
+            pool.shutdown(wait=False)
+        raise
+
+
+# a Redis outage degrades to rendering on every request instead of failing it
+async def cache_get(key: str) -> Optional[Tuple[Any, ...]]:
+    try:
+        return await cache.get(key)
+    except Exception:
+        logger.exception("cache get failed for %s", key)
+        return None
+
+
+async def cache_set(key: str, value: Tuple[Any, ...]) -> None:
+    try:
+        await cache.set(key, value)
+    except Exception:
+        logger.exception("cache set failed for %s", key)
 
 
 @app.middleware("http")
@@ -58,12 +155,166 @@ class Mode(str, Enum):
     stretch = "stretch"
 
 
+class Format(str, Enum):
+    jpeg = "jpeg"
+    webp = "webp"
+    png = "png"
+
+
+SAVE_OPTIONS: Dict[Format, Dict[str, Union[str, int, bool]]] = {
+    Format.jpeg: {
+        "format": "JPEG",
+        "quality": 85,
+        "optimize": False,
+        "progressive": False,
+    },
+    Format.webp: {"format": "WEBP", "method": 4},
+    Format.png: {"format": "PNG", "compress_level": 1, "optimize": False},
+}
+
+
+def image_type(data: bytes) -> Optional[str]:
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    return next((kind for sig, kind in SIGNATURES if data.startswith(sig)), None)
+
+
+# libvips handles these in one streaming decode/resize/encode pass, Pillow does the rest
+VIPS_SOURCES = (".jpg", ".jpeg", ".png", ".webp")
+VIPS_SAVE_SUFFIX: Dict[Format, str] = {
+    Format.jpeg: ".jpg[Q=85]",
+    Format.webp: ".webp[Q=80]",
+    Format.png: ".png[compression=1]",
+}
+
+
 class DBEntry(int, Enum):
     id = 0
     filename = 1
     oryginal_filename = 2
     hash = 3
     created = 4
+    sizes = 5
+
+
+def ladder_filename(fname: str, size: int) -> str:
+    return f"{os.path.splitext(fname)[0]}_{size}.webp"
+
+
+# long edge sizes rendered at upload, each step downsampled from the previous one,
+# stored lossless so they can stand in for the original in every output format
+def create_size_ladder(_fname: str) -> List[int]:
+    sizes: List[int] = []
+    with Image.open(f"files/{_fname}") as image:
+        image.draft("RGB", (SIZE_LADDER[0], SIZE_LADDER[0]))
+        transparent: bool = image.mode in ("RGBA", "LA", "PA") or (
+            "transparency" in image.info
+        )
+        image = image.convert("RGBA" if transparent else "RGB")
+
+    for size in SIZE_LADDER:
+        if size >= max(image.size):
+            continue
+        image.thumbnail((size, size), Image.BICUBIC)
+        image.save(
+            f"files/{ladder_filename(_fname, size)}", format="WEBP", lossless=True
+        )
+        sizes.append(size)
+    return sizes
+
+
+def scale_with_vips(
+    _source_path: str, _target_w: int, _target_h: int, _mode: Mode, _fmt: Format
+) -> Tuple[bytes, str]:
+    image = pyvips.Image.thumbnail(
+        _source_path,
+        _target_w,
+        height=_target_h,
+        size="force" if _mode == Mode.stretch else "both",
+        # the Pillow path and the ladder files ignore EXIF orientation too
+        no_rotate=True,
+    )
+
+    if image.hasalpha():
+        image = image.copy_memory()
+        # fully opaque alpha channel only slows down the encoders
+        if image.extract_band(image.bands - 1).min() == 255:
+            image = image.extract_band(0, n=image.bands - 1)
+    if _fmt == Format.jpeg and image.hasalpha():
+        _fmt = Format.webp
+
+    return image.write_to_buffer(VIPS_SAVE_SUFFIX[_fmt]), _fmt.value
+
+
+# runs in process_pool, so it takes and returns only cheaply picklable values
+def create_scaled_image(
+    _target_w: int,
+    _target_h: int,
+    _mode_value: str,
+    _fmt_value: str,
+    _fname: str,
+    _sizes: Sequence[int] = (),
+) -> Tuple[bytes, str]:
+    _mode: Mode = Mode(_mode_value)
+    _fmt: Format = Format(_fmt_value)
+
+    image: Image = Image.open(f"files/{_fname}")
+    source_w: int
+    source_h: int
+    source_w, source_h = image.size
+
+    if _mode == Mode.match_width or (_mode == Mode.auto and source_w > source_h):
+        _target_h = (_target_w * source_h) // source_w
+    elif _mode != Mode.stretch:
+        _target_w = (_target_h * source_w) // source_h
+
+    # smallest pre-rendered ladder step still covering the target in both axes
+    long_edge: int = max(source_w, source_h)
+    needed: int = max(
+        -(-_target_w * long_edge // source_w), -(-_target_h * long_edge // source_h)
+    )
+    ladder: List[int] = [size for size in _sizes if size >= needed]
+    source_path: str = f"files/{_fname}"
+    if ladder:
+        source_path = f"files/{ladder_filename(_fname, min(ladder))}"
+
+    if pyvips is not None and os.path.splitext(source_path)[1].lower() in VIPS_SOURCES:
+        image.close()
+        return scale_with_vips(source_path, _target_w, _target_h, _mode, _fmt)
+
+    if ladder:
+        image.close()
+        image = Image.open(source_path)
+
+    # lets libjpeg decode JPEG sources at 1/2, 1/4 or 1/8 scale, no-op otherwise
+    image.draft("RGB", (_target_w * 2, _target_h * 2))
+
+    if (
+        _mode != Mode.stretch
+        and _target_w <= image.size[0]
+        and _target_h <= image.size[1]
+    ):
+        image.thumbnail((_target_w, _target_h), Image.BICUBIC)
+    else:
+        image = image.resize((_target_w, _target_h), Image.BICUBIC)
+
+    # fully opaque alpha channel only slows down the encoders
+    if image.mode == "RGBA" and image.getchannel("A").getextrema()[0] == 255:
+        image = image.convert("RGB")
+
+    transparent: bool = image.mode in ("RGBA", "LA", "PA") or (
+        "transparency" in image.info
+    )
+    if _fmt == Format.jpeg and transparent:
+        _fmt = Format.webp
+    if _fmt == Format.jpeg and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    elif _fmt == Format.webp and image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if transparent else "RGB")
+
+    img_byte_arr = io.BytesIO()
+    image.save(img_byte_arr, **SAVE_OPTIONS[_fmt])
+    return img_byte_arr.getvalue(), _fmt.value
 
 
 @app.get("/favicon.ico", include_in_schema=False)
@@ -78,8 +329,20 @@ async def favicon() -> Response:
     )
 
 
+@z_cache(timeout_in_ms=1000 * 5)
+async def max_image_id() -> int:
+    cursor: aiosqlite.Cursor = await db.execute("SELECT MAX(id) FROM IMAGES")
+    (max_id,) = await cursor.fetchone()
+    return max_id or 0
+
+
 @app.get("/images/{target_w}x{target_h}")
-async def get(target_w: int, target_h: int, mode: Mode = Mode.auto) -> BytesIOResponse:
+async def get(
+    target_w: int,
+    target_h: int,
+    mode: Mode = Mode.auto,
+    fmt: Format = Query(Format.jpeg, alias="format"),
+) -> Response:
 
     try:
         target_w = max(0, min(int(target_w), 4096 * 2))
@@ -90,125 +353,110 @@ async def get(target_w: int, target_h: int, mode: Mode = Mode.auto) -> BytesIORe
             detail="Bad parameters, width 0-4096 height 0-8192, 0-8192x0-8192",
         )
 
-    def create_scaled_image(
-        _target_w: int, _target_h: int, _mode: Mode, _fname: str
-    ) -> io.BytesIO:
-
-        image: Image = Image.open(f"files/{_fname}")
-        source_w: int
-        source_h: int
-        source_w, source_h = image.size
-
-        match_width: Callable[
-            [int, int, int, int], Tuple[int, int]
-        ] = lambda __source_w, __source_h, __target_w, __target_h: (
-            __target_w,
-            floor(__target_w * float(__source_h) / float(__source_w)),
-        )
-
-        match_height: Callable[
-            [int, int, int, int], Tuple[int, int]
-        ] = lambda __source_w, __source_h, __target_w, __target_h: (
-            floor(__target_h * float(__source_w) / float(__source_h)),
-            _target_h,
-        )
-
-        stretch: Callable[
-            [int, int, int, int], Tuple[int, int]
-        ] = lambda __source_w, __source_h, __target_w, __target_h: (
-            __target_w,
-            __target_h,
-        )
-
-        auto: Callable[
-            [int, int, int, int], Tuple[int, int]
-        ] = lambda __source_w, __source_h, __target_w, __target_h: (
-            match_width(__source_w, __source_h, __target_w, __target_h)
-            if (__source_w > __source_h)
-            else match_height(__source_w, __source_h, __target_w, __target_h)
-        )
-
-        switch: Dict[Mode, Callable[[int, int, int, int], Tuple[int, int]]] = {
-            Mode.match_width: match_width,
-            Mode.match_height: match_height,
-            Mode.stretch: stretch,
-            Mode.auto: auto,
-        }
+    cache_key: str = f"{target_w}_{target_h}_{mode}_{fmt}"
 
-        _target_w, _target_h = switch[_mode](source_w, source_h, _target_w, _target_h)
-
-        image = image.resize((_target_w, _target_h))
-        img_byte_arr = io.BytesIO()
-        image.save(img_byte_arr, format="PNG")
-        return img_byte_arr
-
-    cache_key: str = f"{target_w}_{target_h}_{mode}"
-
-    img_byte_arr: Optional[io.BytesIO]
+    encoded_bytes: Optional[bytes]
     oryg_filename: Optional[str]
-    creation_date: Optional[Union[str, datetime]]
-    modification_date: Optional[Union[str, datetime]]
+    creation_date: Optional[str]
+    modification_date: Optional[str]
+    expires_at: Optional[int]
     fname: Optional[str]
+    out_fmt: Optional[Format]
+    etag: Optional[str]
+    last_modified_str: Optional[str]
     (
         fname,
         creation_date,
         modification_date,
+        expires_at,
         oryg_filename,
-        img_byte_arr,
-    ) = await cache.get(cache_key) or (None, None, None, None, None)
-
-    if not img_byte_arr:
-        async with aiosqlite.connect("db.db") as db:
+        out_fmt,
+        etag,
+        last_modified_str,
+        encoded_bytes,
+    ) = await cache_get(cache_key) or (None,) * 9
+
+    if not encoded_bytes:
+        row: Union[aiosqlite.Row, None] = None
+        max_id: int = await max_image_id()
+        if max_id:
             cursor: aiosqlite.Cursor = await db.execute(
-                f" SELECT * FROM IMAGES ORDER BY RANDOM() LIMIT 1"
+                "SELECT * FROM IMAGES WHERE id >= ? ORDER BY id LIMIT 1",
+                (random.randint(1, max_id),),
             )
-            row: Union[aiosqlite.Row, None] = await cursor.fetchone()
+            row = await cursor.fetchone()
+            if not row:
+                # cached max id is stale, wrap around to the first entry
+                cursor = await db.execute("SELECT * FROM IMAGES ORDER BY id LIMIT 1")
+                row = await cursor.fetchone()
 
         if not row:
             raise HTTPException(status_code=404, detail="Not Found.")
 
         fname = row[DBEntry.filename]
         oryg_filename = row[DBEntry.oryginal_filename]
-
-        creation_date = datetime.utcfromtimestamp(float(row[DBEntry.created] / 1000))
-
-        img_byte_arr = await loop.run_in_executor(
-            thread_pool, partial(create_scaled_image, target_w, target_h, mode, fname)
+        sizes: List[int] = json.loads(row[DBEntry.sizes])
+
+        creation_date = datetime.utcfromtimestamp(
+            float(row[DBEntry.created] / 1000)
+        ).strftime(DATE_FORMAT)
+
+        out_fmt_value: str
+        encoded_bytes, out_fmt_value = await run_in_process_pool(
+            create_scaled_image,
+            target_w,
+            target_h,
+            mode.value,
+            fmt.value,
+            fname,
+            sizes,
         )
-        modification_date = datetime.now()
-        await cache.set(
+        out_fmt = Format(out_fmt_value)
+        modified: datetime = datetime.now()
+        modification_date = modified.strftime(DATE_FORMAT)
+        expires_at = int(modified.timestamp()) + CACHE_TIME_IN_SEC
+        etag = make_etag(modified, len(encoded_bytes))
+        last_modified_str = format_last_modified(modified)
+        await cache_set(
             cache_key,
-            (fname, creation_date, modification_date, oryg_filename, img_byte_arr),
+            (
+                fname,
+                creation_date,
+                modification_date,
+                expires_at,
+                oryg_filename,
+                out_fmt,
+                etag,
+                last_modified_str,
+                encoded_bytes,
+            ),
         )
 
-    img_byte_arr.seek(0)
+    max_age: int = max(0, expires_at - int(time.time()))
+    read_date: str = formatted_now()
 
-    max_age: int = int(
-        abs(
-            (
-                datetime.now()
-                - (modification_date + timedelta(seconds=CACHE_TIME_IN_SEC))
-            ).total_seconds()
-        )
-    )
-    last_modified = modification_date
-    creation_date = creation_date.strftime("%a, %d %b %y %T %z")
-    modification_date = modification_date.strftime("%a, %d %b %y %T %z")
-    read_date = datetime.now().strftime("%a, %d %b %y %T %z")
-
-    return BytesIOResponse(
-        img_byte_arr,
-        media_type="image/png",
+    return Response(
+        content=encoded_bytes,
+        media_type=f"image/{out_fmt.value}",
         headers={
             "Content-disposition": f'inline;filename="{fname}_{target_w}x{target_h}_{oryg_filename}";creation-date="{creation_date}";modification-date="{modification_date}";read-date="{read_date}"',
             "Cache-Control": f"max-age={max_age}",
+            "ETag": etag,
+            "Last-Modified": last_modified_str,
         },
-        last_modified=last_modified,
     )
 
 
+async def build_size_ladder(image_id: int, fname: str) -> None:
+    sizes: List[int] = await run_in_process_pool(create_size_ladder, fname)
+    await db.execute(
+        "UPDATE IMAGES SET SIZES=? WHERE id=?;", (json.dumps(sizes), image_id)
+    )
+    await db.commit()
+
+
 @app.post("/images", status_code=status.HTTP_201_CREATED)
-async def upload(file: UploadFile = File(...)):
+async def upload(background_tasks: BackgroundTasks, file: UploadFile = File(...)):
     try:
         if file.content_type.split("/")[0] != "image":
             raise HTTPException(
@@ -221,8 +469,8 @@ async def upload(file: UploadFile = File(...)):
             detail="Malformed header. Content-Type",
         )
 
-    data: bytes = await file.read()
-    hdr: str = imghdr.what(None, h=data)
+    chunk: bytes = await file.read(UPLOAD_CHUNK_SIZE)
+    hdr: Optional[str] = image_type(chunk)
     if hdr not in ["jpeg", "png", "gif", "bmp", "webp"]:
         raise HTTPException(
             status_code=400,
@@ -232,29 +480,39 @@ async def upload(file: UploadFile = File(...)):
     if not os.path.exists("files"):
         os.makedirs("files")
 
-    hash: str = hashlib.md5(data).hexdigest()
-
-    async with aiosqlite.connect("db.db") as db:
-        cursor: aiosqlite.Cursor = await db.execute(
-            f"SELECT * FROM IMAGES WHERE hash=?;", (hash,)
-        )
-        rows: Iterable[aiosqlite.Row] = await cursor.fetchall()
-        if rows:
-            raise HTTPException(status_code=409, detail="Entry already exists.")
-
     filename: str = uuid.uuid4().hex
     ext: str = file.filename.split(".")[1]
+    path: str = f"files/{filename}.{ext}"
 
-    async with aiof.open(f"files/{filename}.{ext}", "wb") as out:
-        await out.write(data)
-        await out.flush()
+    try:
+        # hash and write each chunk concurrently, never holding the whole upload
+        hasher = blake3()
+        async with aiof.open(path, "wb") as out:
+            while chunk:
+                await asyncio.gather(
+                    loop.run_in_executor(thread_pool, hasher.update, chunk),
+                    out.write(chunk),
+                )
+                chunk = await file.read(UPLOAD_CHUNK_SIZE)
+            await out.flush()
+        hash: str = hasher.hexdigest()
 
-    async with aiosqlite.connect("db.db") as db:
-        await db.execute(
-            "INSERT INTO IMAGES(FILENAME,FILENAME_ORYGINAL,HASH,CREATED) VALUES(?,?,?,?);",
+        cursor: aiosqlite.Cursor = await db.execute(
+            "INSERT INTO IMAGES(FILENAME,FILENAME_ORYGINAL,HASH,CREATED)"
+            " VALUES(?,?,?,?) ON CONFLICT(HASH) DO NOTHING;",
             (f"{filename}.{ext}", file.filename, hash, current_time_millis()),
         )
         await db.commit()
+    except BaseException:
+        # disconnects cancel the task, so this also has to catch CancelledError
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+
+    if cursor.rowcount == 0:
+        os.remove(path)
+        raise HTTPException(status_code=409, detail="Entry already exists.")
+    background_tasks.add_task(build_size_ladder, cursor.lastrowid, f"{filename}.{ext}")
     return
 
 
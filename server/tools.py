@@ -1,51 +1,60 @@
 import hashlib
-import io
 import time
-from collections import defaultdict
+from collections import OrderedDict
 from email.utils import formatdate
 from functools import wraps
-from typing import Any, Callable, DefaultDict, Dict, Mapping, Optional
-
-import aiofiles
-from starlette.responses import Response
-from starlette.types import Receive, Scope, Send
-from starlette.background import BackgroundTask
+from typing import Any, Callable, Dict, Tuple
 from datetime import datetime
 
 
+DATE_FORMAT = "%a, %d %b %y %T %z"
+
+_formatted_now: Tuple[int, str] = (-1, "")
+
+
 def current_time_millis():
     return round(time.time() * 1000)
 
 
+def formatted_now() -> str:
+    global _formatted_now
+    now = int(time.time())
+    if _formatted_now[0] != now:
+        _formatted_now = (now, datetime.fromtimestamp(now).strftime(DATE_FORMAT))
+    return _formatted_now[1]
+
+
 separator = object()
 
 
-def cache(timeout_in_ms: int = 1000) -> Callable[[], Any]:
+def cache(timeout_in_ms: int = 1000, max_size: int = 128) -> Callable[[], Any]:
+    timeout_in_ns = timeout_in_ms * 1_000_000
+
     def wrapper(func: Callable[[], Any]) -> Callable[[], Any]:
-        store: DefaultDict[Any, Dict[float, Any]] = defaultdict(dict)
+        store: "OrderedDict[Any, Tuple[int, Any]]" = OrderedDict()
 
         @wraps(func)
         async def cached_func(*args: Any, **kwargs: Any):
 
-            call_time = current_time_millis()
-            key = args + (separator,) + tuple(sorted(kwargs.items()))
-            result = None
-            if key in store:
-                for _time, _result in list(store[key].items()):
-                    if call_time - _time < timeout_in_ms:
-                        result = _result
-                    else:
-                        store[key].pop(_time)
-
-            if result:
+            call_time = time.monotonic_ns()
+            key = (args + (separator,) + tuple(kwargs.items())) if kwargs else args
+            entry = store.get(key)
+            if entry is not None and call_time < entry[0]:
+                store.move_to_end(key)
+                result = entry[1]
                 if isinstance(result, Dict):
-                    result["query_time"] = current_time_millis() - call_time
+                    result["query_time"] = (
+                        time.monotonic_ns() - call_time
+                    ) // 1_000_000
                 return result
 
             result = await func(*args, **kwargs)
-            store[key][call_time] = result
+            store[key] = (call_time + timeout_in_ns, result)
+            store.move_to_end(key)
+            if len(store) > max_size:
+                store.popitem(last=False)
             if isinstance(result, Dict):
-                result["query_time"] = current_time_millis() - call_time
+                result["query_time"] = (time.monotonic_ns() - call_time) // 1_000_000
             return result
 
         return cached_func
@@ -53,70 +62,10 @@ def cache(timeout_in_ms: int = 1000) -> Callable[[], Any]:
     return wrapper
 
 
-class BytesIOResponse(Response):
-    chunk_size = 4096
-
-    def __init__(
-        self,
-        bytes_io: io.BytesIO,
-        status_code: int = 200,
-        headers: Optional[Mapping[str, str]] = None,
-        media_type: Optional[str] = None,
-        background: Optional[BackgroundTask] = None,
-        method: Optional[str] = None,
-        last_modified: Optional[datetime] = None,
-    ) -> None:
-        assert aiofiles is not None, "'aiofiles' must be installed to use FileResponse"
-        self.bytes_io = bytes_io
-        self.status_code = status_code
-        self.send_header_only = method is not None and method.upper() == "HEAD"
-        assert (
-            media_type is not None
-        ), "'media_type' must be specified to use BytesIOResponse"
-        self.last_modified = last_modified
-        self.media_type = media_type
-        self.background = background
-        self.init_headers(headers)
-        self.set_headers()
-
-    def set_headers(self) -> None:
-        content_length = str(self.bytes_io.getbuffer().nbytes)
-        if self.last_modified:
-            etag_base = (
-                str(int(self.last_modified.timestamp() * 1000))
-                + "-"
-                + str(self.bytes_io.getbuffer().nbytes)
-            )
-            etag: str = hashlib.md5(etag_base.encode()).hexdigest()
-
-            self.last_modified = formatdate(self.last_modified.timestamp(), usegmt=True)
-            self.headers.setdefault("last-modified", self.last_modified)
-            self.headers.setdefault("etag", etag)
-
-        self.headers.setdefault("content-length", content_length)
-
-    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
-        await send(
-            {
-                "type": "http.response.start",
-                "status": self.status_code,
-                "headers": self.raw_headers,
-            }
-        )
-        if self.send_header_only:
-            await send({"type": "http.response.body", "body": b"", "more_body": False})
-        else:
-            # async with aiofiles.open(self.path, mode="rb") as file:
-            more_body = True
-            while more_body:
-                chunk = self.bytes_io.read(self.chunk_size)
-                more_body = len(chunk) == self.chunk_size
-                await send(
-                    {
-                        "type": "http.response.body",
-                        "body": chunk,
-                        "more_body": more_body,
-                    }
-                )
-        if self.background is not None:
-            await self.background()
+def make_etag(last_modified: datetime, nbytes: int) -> str:
+    etag_base = str(int(last_modified.timestamp() * 1000)) + "-" + str(nbytes)
+    return hashlib.md5(etag_base.encode()).hexdigest()
+
+
+def format_last_modified(last_modified: datetime) -> str:
+    return formatdate(last_modified.timestamp(), usegmt=True)
@@ -24,5 +24,7 @@ else
     echo "There is no script $PRE_START_PATH"
 fi
 
+redis-server --daemonize yes
+
 # Start Uvicorn with live reload
 exec uvicorn --reload --host $HOST --port $PORT --bind unix://var/run/gunicorn/gunicorn.sock --log-level $LOG_LEVEL "$APP_MODULE"
@@ -32,4 +32,5 @@ fi
 
 # Start Gunicorn
 exec nginx &
+redis-server --daemonize yes
 exec gunicorn -k "$WORKER_CLASS" -c "$GUNICORN_CONF" "$APP_MODULE"